@@ -17,34 +17,15 @@ class CumulusPrerequisitesStack(core.Stack):
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
-        internal_bucket = aws_s3.Bucket(
-            self,
-            id=f"{identifier}-{stage}-internal",
+        bucket_kwargs = dict(
             auto_delete_objects=True,
             removal_policy=core.RemovalPolicy.DESTROY,
             block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL
         )
 
-        private_bucket = aws_s3.Bucket(
-            self,
-            id=f"{identifier}-{stage}-private",
-            auto_delete_objects=True,
-            removal_policy=core.RemovalPolicy.DESTROY,
-            block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL
-        )
-
-        protected_bucket = aws_s3.Bucket(
-            self,
-            id=f"{identifier}-{stage}-protected",
-            auto_delete_objects=True,
-            removal_policy=core.RemovalPolicy.DESTROY,
-            block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL
-        )
-
-        public_bucket = aws_s3.Bucket(
-            self,
-            id=f"{identifier}-{stage}-public",
-            auto_delete_objects=True,
-            removal_policy=core.RemovalPolicy.DESTROY,
-            block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL
-        )
+        for suffix in ("internal", "private", "protected", "public"):
+            aws_s3.Bucket(
+                self,
+                id=f"{identifier}-{stage}-{suffix}",
+                **bucket_kwargs
+            )
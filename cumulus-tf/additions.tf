@@ -146,7 +146,12 @@ resource "aws_lambda_function" "hdf4_to_cog" {
   handler       = "main.handler"
   runtime       = "python3.8"
   timeout       = 900
-  memory_size   = 10240
+  memory_size   = 4096
+
+  # /tmp only holds the output COG now that the source hdf streams from S3
+  ephemeral_storage {
+    size = 2048
+  }
 
   source_code_hash = filebase64sha256("${data.external.hdf4_to_cog_build.working_dir}/build/hdf4-to-cog.zip")
 
@@ -164,6 +169,7 @@ resource "aws_lambda_function" "hdf4_to_cog" {
       CMR_ENVIRONMENT             = "UAT"
       CMR_HOST                    = var.cmr_custom_host
       CUMULUS_MESSAGE_ADAPTER_DIR = "/opt"
+      GDAL_CACHEMAX               = "1024"
       GDAL_DATA                   = "/var/task/share/gdal"
       PROJ_LIB                    = "/var/task/share/proj"
       stackName                   = var.prefix
@@ -1,24 +1,91 @@
 """
-    Downloads a MODIS13Q1/MYD13Q1 hdf4 file from s3, extracts specified bands, transforms
+    Reads a MODIS13Q1/MYD13Q1 hdf4 file from s3, extracts specified bands, transforms
     to cloud optimized geotif format, and saves COG to s3. Expects CMA event message input and emits CMA event message.
 """
+import logging
 import os
 import traceback
 import hashlib
-from subprocess import call
+import mmap
+import shutil
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import numpy as np
 import rasterio
-from rio_cogeo.cogeo import cog_translate, cog_validate
-from rio_cogeo.profiles import cog_profiles
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as rio_copy
 
 from run_cumulus_task import run_cumulus_task
 
-# GDAL and COG output config
-gdal_config = dict(GDAL_NUM_THREADS="ALL_CPUS", GDAL_TIFF_OVR_BLOCKSIZE="128")
-output_profile = cog_profiles.get("deflate")
-output_profile.update(dict(blockxsize=256, blockysize=256))
+# CloudWatch ingestion is synchronous on lambda stdout, so per-invocation
+# chatter stays at DEBUG and is only emitted when LOG_LEVEL asks for it
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+# GDAL and COG output config; the module-level profiles are read-only so a warm
+# lambda invocation can never inherit mutations from a prior granule
+# Overview blocks match the 256 main tile size; mismatched sizes make tile
+# servers fetch up to 4x more bytes per mercator tile (rio-cogeo issue #60)
+gdal_config = MappingProxyType(dict(GDAL_NUM_THREADS="ALL_CPUS", GDAL_TIFF_OVR_BLOCKSIZE="256"))
+
+# Creation options for the native GDAL COG driver, which tiles, compresses, and
+# builds overviews in a single write pass
+cog_profile = MappingProxyType(dict(
+    driver="COG",
+    compress="DEFLATE",
+    blocksize=256,
+    overview_resampling="average",
+    # DEFLATE only parallelizes with the per-dataset option, the env-level
+    # GDAL_NUM_THREADS is not enough; predictor 2 helps the int16 MODIS bands
+    num_threads="ALL_CPUS",
+    predictor=2,
+    bigtiff="IF_SAFER",
+))
+
+# GDAL environment for reading the source hdf directly from S3 with ranged GETs,
+# see: https://gdal.org/user/virtual_file_systems.html#vsis3
+gdal_read_env = MappingProxyType(dict(
+    # One GDAL thread per read worker; the band fan-out already covers the vCPUs
+    # and per-dataset threading on top of it would oversubscribe them
+    GDAL_NUM_THREADS="1",
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".hdf",
+    VSI_CACHE="TRUE",
+    VSI_CACHE_SIZE="536870912",
+    GDAL_HTTP_MULTIPLEX="YES",
+    GDAL_HTTP_VERSION="2",
+    # The subdatasets share one EOS grid, so a large HDF4 block size and curl
+    # cache let decoded chunks be reused across the per-band reads
+    HDF4_BLOCK_PIXELS="1000000",
+    CPL_VSIL_CURL_CACHE_SIZE="268435456",
+))
+
+# Concurrent multipart upload for the output COG; chunk size must stay in sync
+# with the default part_size used by compute_file_etag for upload verification
+upload_transfer_config = TransferConfig(
+    multipart_chunksize=8388608,
+    max_concurrency=20,
+    use_threads=True,
+)
+
+# Created once at import so warm lambda invocations reuse the connection pool;
+# the pool is sized past the upload transfer concurrency so multipart threads
+# never block waiting for a connection
+client = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=64,
+        retries={"mode": "adaptive", "max_attempts": 5},
+        # Fail fast on connect so a bad ENI path retries inside the lambda
+        # timeout instead of hanging a whole attempt
+        connect_timeout=3,
+        read_timeout=60,
+    ),
+)
 
 def md5_digest(filename):
     """
@@ -29,12 +96,9 @@ def md5_digest(filename):
     filename : str, Full filename including path of local file    
     """
 
-    md5_hash = hashlib.md5()
-    with open(filename, "rb") as f:
-        for data in iter(lambda: f.read(1024 * 1024), b""):
-            md5_hash.update(data)
-
-    return md5_hash.hexdigest()
+    # One C call over the mapped file instead of a Python loop of 1 MiB reads
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return hashlib.md5(mm).hexdigest()
 
 def get_obj_etag(s3_head_obj):
     """
@@ -75,21 +139,58 @@ def compute_file_etag(filename, part_size=8388608):
     part_size : int, optional, size in MB of each chunk of an S3 multipart upload. Default is 8388608 
         - https://boto3.amazonaws.com/v1/documentation/api/1.9.46/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig   
     """
-    print(f"Computing {filename} etag using part_size={part_size}")
+    logger.debug(f"Computing {filename} etag using part_size={part_size}")
   
     # If file size is smaller than chunksize, mulitpart uploads not triggered and ETags are MD5 digests 
     if os.path.getsize(filename) < part_size:
-        print(f"File size={os.path.getsize(filename)} is smaller than part_size={part_size}, use simple md5 digest")
+        logger.debug(f"File size={os.path.getsize(filename)} is smaller than part_size={part_size}, use simple md5 digest")
         return md5_digest(filename)
 
-    # If mulitpart upload, concatenate md5s and append with chunk count
-    md5_hashs = []
-    with open(filename, "rb") as f:
-        for data in iter(lambda: f.read(part_size), b""):
-            md5_hashs.append(hashlib.md5(data).digest())
+    # If mulitpart upload, concatenate md5s and append with chunk count; the parts
+    # are independent and hashlib drops the GIL on large buffers, so hash
+    # zero-copy slices of the mapped file across a thread pool
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                md5_hashs = list(executor.map(
+                    lambda i: hashlib.md5(view[i:i + part_size]).digest(),
+                    range(0, len(view), part_size)))
     md5_hash = hashlib.md5(b"".join(md5_hashs))
     return f"{md5_hash.hexdigest()}-{len(md5_hashs)}"
 
+def md5_and_etag(filename, part_size=8388608):
+    """
+    Returns the MD5 digest and expected S3 ETag for a given filename in a single pass over the file,
+    instead of one full read for the digest and a second for the ETag parts.
+
+    Parameters
+    ----------
+    filename : str, Full filename including path of local file
+
+    part_size : int, optional, size in MB of each chunk of an S3 multipart upload. Default is 8388608
+        - https://boto3.amazonaws.com/v1/documentation/api/1.9.46/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
+    """
+    logger.debug(f"Computing {filename} md5 and etag using part_size={part_size}")
+
+    # If file size is smaller than chunksize, mulitpart uploads not triggered and ETags are MD5 digests
+    if os.path.getsize(filename) < part_size:
+        digest = md5_digest(filename)
+        return digest, digest
+
+    # The pages are mapped once; the whole-file digest is inherently serial but
+    # the per-part digests run in parallel over slices of the same buffer
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                parts = executor.map(
+                    lambda i: hashlib.md5(view[i:i + part_size]).digest(),
+                    range(0, len(view), part_size))
+                md5_hash = hashlib.md5(mm)
+                part_md5s = list(parts)
+
+    etag_hash = hashlib.md5(b"".join(part_md5s))
+    return md5_hash.hexdigest(), f"{etag_hash.hexdigest()}-{len(part_md5s)}"
+
 def verify_file_etag(filename, s3_etag, part_size=8388608):
     """
     Compares the expected ETag for a given local file to the corresponding S3 head object and returns T/F. 
@@ -105,9 +206,40 @@ def verify_file_etag(filename, s3_etag, part_size=8388608):
     """
     
     computed_etag = compute_file_etag(filename, part_size)
-    print(f"Verify {filename} part_size={part_size} computed_etag={computed_etag} s3_etag={s3_etag}")
+    logger.debug(f"Verify {filename} part_size={part_size} computed_etag={computed_etag} s3_etag={s3_etag}")
     return computed_etag==s3_etag
 
+# Collection specific configurations with variable names to extract and a
+# template dataset, built once at import; paired collections share one
+# read-only object
+modis_configs = dict(
+    MOD13Q1_COG=MappingProxyType(dict(
+        variable_names=(
+            "250m 16 days NDVI",
+            "250m 16 days pixel reliability",
+            "250m 16 days EVI",
+            "250m 16 days red reflectance",
+            "250m 16 days NIR reflectance",
+            "250m 16 days blue reflectance",
+            "250m 16 days MIR reflectance"
+        ),
+        # Native int16 scale factors published as band metadata so consumers
+        # apply them via the standard GDAL scale/offset mechanism; the
+        # pixel reliability band is categorical and unscaled
+        scale_factors=MappingProxyType({
+            "250m 16 days NDVI": 0.0001,
+            "250m 16 days EVI": 0.0001,
+            "250m 16 days red reflectance": 0.0001,
+            "250m 16 days NIR reflectance": 0.0001,
+            "250m 16 days blue reflectance": 0.0001,
+            "250m 16 days MIR reflectance": 0.0001
+        }),
+        tpl_dst="250m 16 days NDVI",
+        group_name="MODIS_Grid_16DAY_250m_500m_VI"
+    ))
+)
+modis_configs["MYC13Q1_COG"] = modis_configs["MOD13Q1_COG"]
+
 def get_modis_config(data_type):
     """
     Returns a dict with variable names to extract and a template dataset for a given collection.
@@ -116,28 +248,13 @@ def get_modis_config(data_type):
     ----------
     data_type : str, Data type is the name of the granule's destination collection
     """
-    if data_type in ["MOD13Q1_COG", "MYC13Q1_COG"]:
-        return dict(
-            variable_names=[
-                "250m 16 days NDVI",
-                "250m 16 days pixel reliability",
-                "250m 16 days EVI",
-                "250m 16 days red reflectance",
-                "250m 16 days NIR reflectance",
-                "250m 16 days blue reflectance",
-                "250m 16 days MIR reflectance"
-            ],
-            tpl_dst="250m 16 days NDVI",
-            group_name="MODIS_Grid_16DAY_250m_500m_VI"
-        )
-    elif data_type in ["MOD14A1_COG", "MYD14A_COG"]:
+    if data_type in ["MOD14A1_COG", "MYD14A_COG", "MCD64A_COG"]:
         # TODO
         raise Exception(f"Granule dataType={data_type} not yet supported")
 
-    elif data_type in ["MCD64A_COG"]:
-        # TODO
-        raise Exception(f"Granule dataType={data_type} not yet supported")
-    else: 
+    try:
+        return modis_configs[data_type]
+    except KeyError:
         raise Exception(f"Granule dataType={data_type} not supported")
 
 def get_subdataset_name(hdf_filename, group_name, variable_name):
@@ -160,27 +277,30 @@ def get_subdataset_name(hdf_filename, group_name, variable_name):
 
 def generate_and_upload_cog(granule):
     """
-    Downloads granule hdf from S3, transforms specified variables/sub datasets to COG, 
+    Reads granule hdf directly from S3, transforms specified variables/sub datasets to COG,
     publishes back to same S3 staging area.
 
     Parameters
     ----------
     granule : dict, Granule object parsed from Cumulus Message Adapter event input.
 
-    file_staging_dir : str, S3 object key pattern for staged hdf inputs and tif outputs. 
+    file_staging_dir : str, S3 object key pattern for staged hdf inputs and tif outputs.
     """
-    
-    client = boto3.client("s3")
 
     file_meta = granule["files"][0]
     src_filename = file_meta["name"]
-    temp_filename = f"/tmp/{src_filename}"
     file_staging_dir = file_meta["fileStagingDir"]
     src_key = f"{file_staging_dir}/{src_filename}"
     bucket = os.environ["BUCKET"]
 
+    # Read the hdf in place on S3 so GDAL only fetches the bytes it needs
+    src_vsis3_filename = f"/vsis3/{bucket}/{src_key}"
+
     # Get the collection specific configuration for this granule
     modis_config = get_modis_config(granule["dataType"])
+    variable_names = modis_config["variable_names"]
+    group_name = modis_config["group_name"]
+    scale_factors = modis_config["scale_factors"]
 
     output_s3_filename = src_filename.replace(".hdf", ".tif")
     output_s3_path = "/".join([
@@ -188,119 +308,116 @@ def generate_and_upload_cog(granule):
         output_s3_filename,
     ])
 
-    client.download_file(
-        Bucket=bucket,
-        Key=src_key,
-        Filename=temp_filename,
-    )
-
-    # Verify download
-    assert(os.path.exists(temp_filename))
-    assert(".hdf" in temp_filename)
-
-    download_head_obj = client.head_object(Bucket=bucket, Key=src_key)
-    download_etag = get_obj_etag(download_head_obj)
-    download_parts = get_part_count(download_etag)
-
-    # Get mulit part upload chunk size from first part
-    if download_parts > 1:
-        download_part_1 = client.head_object(Bucket=bucket, Key=src_key, PartNumber=1)
-        download_part_size = download_part_1["ContentLength"]
-        successful_download = verify_file_etag(temp_filename, download_etag, download_part_size)
-    else:
-        successful_download = verify_file_etag(temp_filename, download_etag)
-
-    if not successful_download:
-        raise Exception(f"S3 download to {temp_filename} could not be verified with ETag")
+    logger.debug(f"Starting on filename={src_vsis3_filename}")
 
-    print(f"Starting on filename={temp_filename} size={os.path.getsize(temp_filename)}")
-    # Extract some dimensional properties from the template dataset to apply to all bands in output COG
-    tpl_dst_name = get_subdataset_name(temp_filename, modis_config["group_name"], modis_config["tpl_dst"])
-    
-    with rasterio.open(tpl_dst_name) as tpl_dst:
-
-        # Add metadata to rw_profile that will be used to read and set datatype for all datasets
-        rw_profile = dict(
-            count=len(modis_config["variable_names"]),
-            driver="GTiff",
-            transform=tpl_dst.transform,
-            height=tpl_dst.height,
-            width=tpl_dst.width,
-            crs=tpl_dst.crs,
-            nodata=tpl_dst.nodata,
-            dtype=tpl_dst.dtypes[0])
-
-    # Iterate over modis_config variable_names to create bands from subdatasets
-    bands = []
-    for variable_name in modis_config["variable_names"]:
-        
-        sub_dst_name = get_subdataset_name(temp_filename, modis_config["group_name"], variable_name)
-
-        with rasterio.open(sub_dst_name) as sub_dst:
-            
-            # Read band array 
-            band_data = sub_dst.read(1)
-
-            # Recast data type and nodata if different from template dataset
-            if any([sub_dst.nodata != rw_profile["nodata"], sub_dst.dtypes[0] != rw_profile["dtype"]]):
-                band_data = np.where(band_data != sub_dst.nodata, band_data.astype(rw_profile["dtype"]), rw_profile["nodata"])
-            
-            # Add band to output
-            bands.append({
+    def read_band(variable_name, sub_dst_name):
+        """Reads one subdataset into memory; runs in a worker thread, GDAL releases the GIL during I/O."""
+        with rasterio.Env(**gdal_read_env), rasterio.open(sub_dst_name) as sub_dst:
+            return {
                 "name": variable_name,
-                "data": band_data.astype(rw_profile["dtype"])
-            })
-               
-        # End subdatasets
-
-    # We will sometimes exceed the allowed space in /tmp 
-    if os.path.exists(temp_filename):
-        os.remove(temp_filename)
-
-    # Write to local
-    output_filename = temp_filename.replace(".hdf", ".tif")
-    with rasterio.open(output_filename, "w", **rw_profile) as outfile:
-
-        for idx, band in enumerate(bands, 1):
-            outfile.write(band["data"], idx)
-            outfile.set_band_description(idx, band["name"])
-
-        cog_translate(
-            outfile,
-            output_filename,
-            output_profile,
-            config=gdal_config,
-            overview_resampling="nearest",
-            use_cog_driver=True,
-            quiet=True
-        ) 
-        assert cog_validate(output_filename)[0]
+                "data": sub_dst.read(1),
+                "nodata": sub_dst.nodata,
+                "dtype": sub_dst.dtypes[0],
+            }
+
+    # Assemble the bands in an in-memory dataset and translate straight to the
+    # output COG on /tmp, skipping the intermediate tif write and read-back
+    output_filename = f"/tmp/{output_s3_filename}"
+    with ThreadPoolExecutor(max_workers=len(variable_names)) as executor:
+
+        # Kick off the band reads first so the template metadata read below
+        # overlaps with them instead of gating them; subdataset names are
+        # formatted up front rather than in each worker
+        futures = {
+            executor.submit(
+                read_band,
+                variable_name,
+                get_subdataset_name(src_vsis3_filename, group_name, variable_name),
+            ): idx
+            for idx, variable_name in enumerate(variable_names, 1)
+        }
 
-    # Compute the MD5 digest for the granule metadata
-    granule_md5 = md5_digest(output_filename)
+        # Extract some dimensional properties from the template dataset to apply to all bands in output COG
+        tpl_dst_name = get_subdataset_name(src_vsis3_filename, group_name, modis_config["tpl_dst"])
+        with rasterio.Env(**gdal_read_env), rasterio.open(tpl_dst_name) as tpl_dst:
+
+            # Add metadata to rw_profile that will be used to read and set datatype for all datasets;
+            # tile the intermediate dataset on the COG block size so the COG copy
+            # re-tiles nothing and block reads stay aligned end to end
+            rw_profile = dict(
+                count=len(variable_names),
+                driver="GTiff",
+                transform=tpl_dst.transform,
+                height=tpl_dst.height,
+                width=tpl_dst.width,
+                crs=tpl_dst.crs,
+                nodata=tpl_dst.nodata,
+                dtype=tpl_dst.dtypes[0],
+                tiled=True,
+                blockxsize=cog_profile["blocksize"],
+                blockysize=cog_profile["blocksize"])
+
+        with MemoryFile() as memfile:
+            with memfile.open(**rw_profile) as outfile:
+
+                # Write each band into the output dataset as it lands so only
+                # one band is ever held outside it
+                band_scales = [1.0] * len(variable_names)
+                # One boolean mask buffer shared by every recast, allocated only
+                # if some band actually needs one
+                nodata_mask = None
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    band = future.result()
+                    band_data = band["data"]
+
+                    # One tuple compare against the template dimensions, no per-key loop
+                    assert band_data.shape == (rw_profile["height"], rw_profile["width"])
+
+                    # Recast data type and nodata on the main thread if different from template dataset
+                    if band["nodata"] != rw_profile["nodata"] or band["dtype"] != rw_profile["dtype"]:
+                        # Mask nodata before the cast so only one full-size copy is allocated
+                        if nodata_mask is None:
+                            nodata_mask = np.empty(band_data.shape, dtype=np.bool_)
+                        np.equal(band_data, band["nodata"], out=nodata_mask)
+                        # copy=False makes the cast a no-op when only nodata differs
+                        band_data = band_data.astype(rw_profile["dtype"], copy=False)
+                        band_data[nodata_mask] = rw_profile["nodata"]
+
+                    outfile.write(band_data, idx)
+                    outfile.set_band_description(idx, band["name"])
+                    band_scales[idx - 1] = scale_factors.get(band["name"], 1.0)
+
+                outfile.scales = band_scales
+
+                with rasterio.Env(**gdal_config):
+                    rio_copy(outfile, output_filename, **cog_profile)
+    # The COG driver yields a valid COG by construction; re-validating
+    # walks every IFD again so it is opt-in for debugging
+    if os.environ.get("VALIDATE_COG") == "1":
+        # Deferred so the debug-only rio_cogeo dependency stays off the cold-start path
+        from rio_cogeo.cogeo import cog_validate
+        assert cog_validate(output_filename)[0]
 
     # Upload COG to S3
-    client.upload_file(output_filename, bucket, output_s3_path)
+    client.upload_file(output_filename, bucket, output_s3_path, Config=upload_transfer_config)
 
-    # Verify the S3 upload
+    # Verify the S3 upload; the part size is our own TransferConfig constant so
+    # no head_object(PartNumber=1) round trip is needed to discover it
     upload_head_obj = client.head_object(Bucket=bucket, Key=output_s3_path)
     upload_etag = get_obj_etag(upload_head_obj)
-    upload_parts = get_part_count(upload_etag)
+    upload_part_size = upload_transfer_config.multipart_chunksize
 
-    # Get mulit part upload chunk size from first part
-    if upload_parts > 1:
-        upload_part_1 = client.head_object(Bucket=bucket, Key=output_s3_path, PartNumber=1)
-        upload_part_size = upload_part_1["ContentLength"]
-        successful_upload = verify_file_etag(output_filename, upload_etag, upload_part_size)
-    else:
-        successful_upload = verify_file_etag(output_filename, upload_etag)
-    if not successful_upload:
+    # Compute the granule metadata MD5 digest and the expected ETag in one pass
+    granule_md5, computed_etag = md5_and_etag(output_filename, upload_part_size)
+    logger.debug(f"Verify {output_filename} part_size={upload_part_size} computed_etag={computed_etag} s3_etag={upload_etag}")
+    if computed_etag != upload_etag:
         raise Exception(f"S3 upload to {output_s3_path} could not be verified with ETag")
 
     # Parse some file metadata from the head object for granule metadata
     file_size = upload_head_obj["ContentLength"] 
     file_created_time = f"{upload_head_obj['LastModified'].isoformat().replace('+00:00', '.000Z')}"
-    print(f"Finished processing and uploading s3://{bucket}/{output_s3_path} size={file_size}")
+    logger.info(f"Finished processing and uploading s3://{bucket}/{output_s3_path} size={file_size}")
 
     return {
         "path": f"/{output_s3_path}",
@@ -312,11 +429,25 @@ def generate_and_upload_cog(granule):
         "md5": granule_md5 # TODO where do we want this property in Cumulus and in CMR?
     }
 
+def clear_tmp():
+    """
+    Removes everything under /tmp without forking a shell; lambda containers reuse
+    /tmp across invocations so leftover output files would accumulate.
+    """
+    for entry in os.scandir("/tmp"):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
 def task(event, context):
-    
+
     # cleanup /tmp
-    call("rm -rf /tmp/*", shell=True)
-    
+    clear_tmp()
+
     try:
         granule = event["input"]["granules"][0]
 
@@ -324,13 +455,13 @@ def task(event, context):
             **granule["files"][0],
             **generate_and_upload_cog(granule)
         }
-        call("rm -rf /tmp/*", shell=True)
+        clear_tmp()
         return {
                 "granules": [granule]
             }
     except Exception as e:
         traceback.print_exc()
-        call("rm -rf /tmp/*", shell=True)
+        clear_tmp()
         raise Exception(f"Failed with exception={e}, see traceback")
 
 def handler(event, context):